@@ -0,0 +1,106 @@
+import re
+
+# ------------------------------
+# ルールベースの服装アドバイス（LLM 不要の高速パス）
+# 気温帯・天気カテゴリ・降水量・寒暖差のテーブルから文章を組み立てる
+# ------------------------------
+
+# 最高気温の下限 → (服装, 晴れ・曇りの日だけ添える日差し対策)（上から順に判定）
+TEMP_BANDS = [
+    (30, "真夏日です。半袖・通気性の良い服装で、暑さ対策をしましょう。", "帽子や日焼け止めで日差し対策も忘れずに。"),
+    (25, "半袖で快適に過ごせます。", "日差しが強い時間は帽子があると安心です。"),
+    (20, "長袖シャツや薄手のカーディガンがちょうど良い気温です。", ""),
+    (15, "長袖に軽めのジャケットなど上着を用意しましょう。", ""),
+    (10, "セーターや厚手の上着が必要です。", ""),
+    (5, "コートを着て、マフラーなどで首元も暖かくしましょう。", ""),
+    (None, "ダウンコート・手袋・マフラーなどで防寒を万全にしましょう。", ""),
+]
+
+# 天気コード（weather_fetcher.WEATHER_CODE_JP と同じ WMO コード）→ カテゴリ
+WEATHER_CODE_CATEGORY = {
+    0: "clear", 1: "clear", 2: "cloudy", 3: "cloudy",
+    45: "fog", 48: "fog",
+    51: "rain", 53: "rain", 55: "rain",
+    61: "rain", 63: "rain", 65: "heavy_rain",
+    71: "snow", 73: "snow", 75: "snow",
+    80: "rain", 81: "rain", 82: "heavy_rain",
+    95: "thunder", 96: "thunder", 99: "thunder",
+}
+
+# 天気の文字列 → カテゴリ（WEATHER_CODE_JP / OpenWeather / 月平均の表記に対応、上から順に判定）
+CONDITION_KEYWORDS = [
+    ("雷", "thunder"),
+    ("雪", "snow"),
+    ("雨（強い）", "heavy_rain"),
+    ("強い雨", "heavy_rain"),
+    ("雨", "rain"),
+    ("霧", "fog"),
+    ("曇", "cloudy"),
+    ("雲", "cloudy"),
+    ("晴", "clear"),
+]
+
+CATEGORY_ADVICE = {
+    "clear": "",
+    "cloudy": "",
+    "fog": "霧で見通しが悪いので、明るい色の服が安心です。",
+    "rain": "雨が予想されるので、折りたたみ傘と濡れにくい靴を用意しましょう。",
+    "heavy_rain": "強い雨が予想されるので、レインコートと防水の靴がおすすめです。",
+    "snow": "雪が予想されるので、滑りにくい防水の靴と手袋を用意しましょう。",
+    "thunder": "雷雨の可能性があるので、レインコートを用意し屋内で過ごせる予定も考えておきましょう。",
+}
+
+SWING_THRESHOLD = 10  # 寒暖差（°C）がこれ以上なら羽織りものを勧める
+
+def parse_temp(value):
+    """'23.4°C' / '23.4°C (月平均)' / 23.4 → 23.4（解釈できなければ None）"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = re.search(r"-?\d+(?:\.\d+)?", str(value or ""))
+    return float(m.group()) if m else None
+
+def weather_category(condition=None, code=None):
+    if code is not None and code in WEATHER_CODE_CATEGORY:
+        return WEATHER_CODE_CATEGORY[code]
+    text = str(condition or "")
+    for keyword, category in CONDITION_KEYWORDS:
+        if keyword in text:
+            return category
+    return None
+
+def local_clothing_advice(max_temp, min_temp, condition=None, precipitation=None, code=None):
+    max_t, min_t = parse_temp(max_temp), parse_temp(min_temp)
+    if max_t is None and min_t is None:
+        return None
+    ref = max_t if max_t is not None else min_t
+
+    text, sun_tip = next((text, sun_tip) for lower, text, sun_tip in TEMP_BANDS if lower is None or ref >= lower)
+    parts = [text]
+
+    if max_t is not None and min_t is not None and max_t - min_t >= SWING_THRESHOLD:
+        parts.append(f"昼夜の寒暖差が{max_t - min_t:.0f}°Cあるので、朝晩用に羽織るものを持ちましょう。")
+    elif min_t is not None and min_t < 15 <= ref:
+        parts.append("夜は冷えるので薄手の上着があると安心です。")
+
+    category = weather_category(condition, code)
+    if category in ("clear", "cloudy", None) and precipitation is not None and precipitation >= 1:
+        category = "rain"
+    if category in ("clear", "cloudy") and sun_tip:
+        parts.append(sun_tip)
+    if CATEGORY_ADVICE.get(category):
+        parts.append(CATEGORY_ADVICE[category])
+
+    return "".join(parts)
+
+def is_unusual_day(max_temp, min_temp, condition=None, precipitation=None, code=None):
+    """ルールだけでは不十分な日（ハイブリッドモードで LLM に回す日）"""
+    max_t, min_t = parse_temp(max_temp), parse_temp(min_temp)
+    if max_t is None or min_t is None:
+        return True
+    if max_t >= 35 or min_t <= 0 or max_t - min_t >= 15:
+        return True
+    if weather_category(condition, code) in ("heavy_rain", "snow", "thunder"):
+        return True
+    if precipitation is not None and precipitation >= 30:
+        return True
+    return False
@@ -0,0 +1,107 @@
+import importlib.util, os
+from datetime import date, timedelta
+
+# ------------------------------
+# plan_weather_requests / get_weather の動作確認（API は呼ばない）
+# function_calling / tool_calling 両方の weather_fetcher.py を検査する
+#   python function_calling/check_weather_plan.py
+# ------------------------------
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TODAY = date(2026, 10, 19)
+
+TOKYO = (35.68, 139.77)
+ISHIGAKI = (24.34, 124.16)
+SEOUL = (37.57, 126.98)
+BUSAN = (35.10, 129.04)
+VLADIVOSTOK = (43.12, 131.89)
+PARIS = (48.86, 2.35)
+
+def load(path):
+    spec = importlib.util.spec_from_file_location(f"weather_fetcher_{os.path.basename(os.path.dirname(path))}", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def summarize(plan):
+    return [(r["source"], r["start"].isoformat(), r["end"].isoformat()) for r in plan]
+
+def check_is_in_japan(wf):
+    for lat, lon in (TOKYO, ISHIGAKI, (43.06, 141.35), (33.59, 130.40), (26.21, 127.68), (34.20, 129.29)):
+        assert wf.is_in_japan(lat, lon), (lat, lon)
+    for lat, lon in (SEOUL, BUSAN, (35.54, 129.31), VLADIVOSTOK, (25.03, 121.56), PARIS):
+        assert not wf.is_in_japan(lat, lon), (lat, lon)
+
+def check_plans(wf):
+    d = lambda s: date.fromisoformat(s)
+
+    # 国内の短期旅行: JMA だけ（Climate は呼ばない）
+    plan, skipped = wf.plan_weather_requests(*TOKYO, d("2026-10-20"), d("2026-10-22"), TODAY)
+    assert summarize(plan) == [("JMA", "2026-10-20", "2026-10-22")], plan
+    assert {s["source"] for s in skipped} == {"Forecast", "Climate"}
+
+    # 海外旅行: JMA をスキップ（ソウルも含む）
+    for coords in (PARIS, SEOUL):
+        plan, skipped = wf.plan_weather_requests(*coords, d("2026-10-20"), d("2026-10-25"), TODAY)
+        assert summarize(plan) == [("Forecast", "2026-10-20", "2026-10-25")], plan
+        assert any(s["source"] == "JMA" and "日本国外" in s["reason"] for s in skipped)
+
+    # 過去の日付を含む: 過去分は Climate
+    plan, _ = wf.plan_weather_requests(*TOKYO, d("2026-10-01"), d("2026-10-25"), TODAY)
+    assert summarize(plan) == [
+        ("JMA", "2026-10-19", "2026-10-22"),
+        ("Forecast", "2026-10-23", "2026-10-25"),
+        ("Climate", "2026-10-01", "2026-10-18"),
+    ], plan
+
+    # 予報範囲より先: Climate だけ
+    plan, _ = wf.plan_weather_requests(*TOKYO, d("2027-01-01"), d("2027-01-03"), TODAY)
+    assert summarize(plan) == [("Climate", "2027-01-01", "2027-01-03")], plan
+
+    # 長期旅行: JMA → Forecast → Climate が重ならない
+    plan, _ = wf.plan_weather_requests(*TOKYO, d("2026-10-20"), d("2026-11-20"), TODAY)
+    assert summarize(plan) == [
+        ("JMA", "2026-10-20", "2026-10-22"),
+        ("Forecast", "2026-10-23", "2026-11-02"),
+        ("Climate", "2026-11-03", "2026-11-20"),
+    ], plan
+
+def check_gap_fill(wf):
+    # JMA が 10-22 を null で返したら、Climate より先に Forecast で補完する
+    calls = []
+
+    def fake_fetch_daily(api_url, lat, lon, start_date, end_date, include_weathercode=True):
+        source = api_url.rsplit("/", 1)[-1]
+        calls.append((source, start_date, end_date))
+        start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        days = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+        daily = {
+            "time": days,
+            "temperature_2m_max": [None if source == "jma" and ds == "2026-10-22" else 20.0 for ds in days],
+            "temperature_2m_min": [10.0] * len(days),
+            "precipitation_sum": [0.0] * len(days),
+        }
+        if include_weathercode:
+            daily["weathercode"] = [1] * len(days)
+        return daily
+
+    original = wf.fetch_daily
+    wf.fetch_daily = fake_fetch_daily
+    try:
+        rows = wf.get_weather(*TOKYO, "2026-10-19", "2026-10-25", today=TODAY)
+    finally:
+        wf.fetch_daily = original
+
+    by_date = {r["date"]: r for r in rows}
+    assert len(rows) == 7, rows
+    assert by_date["2026-10-22"]["source"] == "Forecast", by_date["2026-10-22"]
+    assert by_date["2026-10-22"]["temp_max"] == 20.0
+    assert ("forecast", "2026-10-22", "2026-10-22") in calls, calls
+    assert not any(c[0] == "climate" for c in calls), calls
+
+if __name__ == "__main__":
+    for sub in ("function_calling", "tool_calling"):
+        wf = load(os.path.join(ROOT, sub, "weather_fetcher.py"))
+        check_is_in_japan(wf)
+        check_plans(wf)
+        check_gap_fill(wf)
+        print(f"✅ {sub}/weather_fetcher.py OK")
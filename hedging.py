@@ -0,0 +1,175 @@
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ------------------------------
+# ヘッジリクエスト＋サーキットブレーカー（フォールバックチェーン用）
+# 先頭プロバイダが応答時間のパーセンタイルを超えたら次を並行で投げ、
+# 先に成功した結果を採用する（未開始の呼び出しはキャンセル）
+# ------------------------------
+class LatencyStats:
+    def __init__(self, window: int = 50):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self):
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p: float):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, int(round(p * (len(samples) - 1))))
+        return samples[idx]
+
+class CircuitBreaker:
+    """連続失敗が閾値を超えたら reset_timeout 秒間スキップ（その後は1回だけ試行し、成否で閉じる/再度開く）"""
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False  # half-open の試行中
+        self._lock = threading.Lock()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def allow(self):
+        """呼び出してよければ True。half-open では最初の1件だけ通し、結果が出るまで他は通さない"""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def release(self):
+        """allow() で得た試行枠を使わなかった場合に返す"""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failure_threshold:
+                # half-open での失敗も含め、ここからまた reset_timeout 秒スキップ
+                self.opened_at = time.monotonic()
+
+class Provider:
+    def __init__(self, name: str, fn, breaker: CircuitBreaker = None):
+        self.name = name
+        self.fn = fn
+        self.stats = LatencyStats()
+        self.breaker = breaker or CircuitBreaker()
+
+class HedgedChain:
+    """providers を優先順に並べたフォールバックチェーン。fn が None を返したら「該当なし」扱いで次へ進む"""
+    def __init__(self, providers, hedge_percentile: float = 0.9, default_delay: float = 1.0, min_samples: int = 5):
+        self.providers = [p if isinstance(p, Provider) else Provider(*p) for p in providers]
+        self.hedge_percentile = hedge_percentile
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+
+    def hedge_delay(self, provider: Provider):
+        if provider.stats.count() < self.min_samples:
+            return self.default_delay
+        return provider.stats.percentile(self.hedge_percentile)
+
+    def _timed(self, provider: Provider, args, kwargs):
+        start = time.monotonic()
+        try:
+            result = provider.fn(*args, **kwargs)
+        except Exception:
+            provider.breaker.record_failure()
+            raise
+        provider.stats.add(time.monotonic() - start)
+        provider.breaker.record_success()
+        return result
+
+    def call(self, *args, **kwargs):
+        queue = []
+        for p in self.providers:
+            if p.breaker.allow():
+                queue.append(p)
+            else:
+                print(f"⚠️ {p.name} はサーキットオープン中のためスキップ")
+        if not queue:
+            return None
+
+        ex = ThreadPoolExecutor(max_workers=len(queue))
+        pending = {}
+        last = None
+
+        def launch():
+            nonlocal last
+            last = queue.pop(0)
+            pending[ex.submit(self._timed, last, args, kwargs)] = last
+
+        try:
+            launch()
+            while pending:
+                # 次の候補が残っていれば、直近に投げたプロバイダのパーセンタイルでヘッジ
+                timeout = self.hedge_delay(last) if queue else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    launch()
+                    continue
+
+                for fut in done:
+                    provider = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        print(f"⚠️ {provider.name} で取得失敗:", e)
+                        result = None
+                    if result is not None:
+                        return result
+                # 失敗・該当なしなら待たずに次の候補へ
+                if queue:
+                    launch()
+            return None
+        finally:
+            # 投げなかった候補の half-open 試行枠を返す
+            for p in queue:
+                p.breaker.release()
+            # 実行中の HTTP 呼び出しは中断できないため結果を捨てる（統計・ブレーカーには反映される）
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """ヘッジ遅延のチューニング用にプロバイダごとの統計を返す"""
+        return {
+            p.name: {
+                "samples": p.stats.count(),
+                "p50": p.stats.percentile(0.5),
+                "p90": p.stats.percentile(0.9),
+                "hedge_delay": self.hedge_delay(p),
+                "breaker": p.breaker.state,
+                "failures": p.breaker.failures,
+            }
+            for p in self.providers
+        }
@@ -1,8 +1,12 @@
 from openai import OpenAI
 from dotenv import load_dotenv
-import os, json, requests, math
+import os, re, json, requests, math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from difflib import SequenceMatcher
+from stage_graph import StageGraph, NoCache
+from hedging import HedgedChain
+from clothing_rules import local_clothing_advice, is_unusual_day
 
 # .env 読み込み
 load_dotenv()
@@ -73,78 +77,103 @@ def deduplicate_hotels(candidates, name_threshold=0.85, coord_threshold=0.01):
     return unique
 
 # ------------------------------
-# 座標取得（Open-Meteo + OpenWeather フォールバック）
+# 座標取得（Open-Meteo + OpenWeather フォールバック、ヘッジリクエスト）
+# Open-Meteo が遅い場合は応答時間のパーセンタイル経過で OpenWeather を並行で投げる
 # ------------------------------
-def get_coordinates(location: str):
-    try:
-        url = f"https://geocoding-api.open-meteo.com/v1/search?name={requests.utils.quote(location)}&count=1&language=ja&format=json"
-        resp = requests.get(url, timeout=10).json()
-        if "results" in resp and len(resp["results"]) > 0:
-            return {"lat": resp["results"][0]["latitude"], "lon": resp["results"][0]["longitude"]}
-    except Exception as e:
-        print("⚠️ Open-Meteo で座標取得失敗:", e)
-
-    try:
-        api_key = os.getenv("OPENWEATHER_API_KEY")
-        url = f"http://api.openweathermap.org/geo/1.0/direct?q={requests.utils.quote(location)}&limit=1&appid={api_key}"
-        resp = requests.get(url, timeout=10).json()
-        if isinstance(resp, list) and len(resp) > 0:
-            return {"lat": resp[0]["lat"], "lon": resp[0]["lon"]}
-    except Exception as e:
-        print("⚠️ OpenWeatherMap で座標取得失敗:", e)
+def _geocode_open_meteo(location: str):
+    url = f"https://geocoding-api.open-meteo.com/v1/search?name={requests.utils.quote(location)}&count=1&language=ja&format=json"
+    resp = requests.get(url, timeout=10).json()
+    if "results" in resp and len(resp["results"]) > 0:
+        return {"lat": resp["results"][0]["latitude"], "lon": resp["results"][0]["longitude"]}
+    return None
 
+def _geocode_openweather(location: str):
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    url = f"http://api.openweathermap.org/geo/1.0/direct?q={requests.utils.quote(location)}&limit=1&appid={api_key}"
+    resp = requests.get(url, timeout=10).json()
+    if isinstance(resp, list) and len(resp) > 0:
+        return {"lat": resp[0]["lat"], "lon": resp[0]["lon"]}
     return None
 
+GEOCODER = HedgedChain([
+    ("Open-Meteo", _geocode_open_meteo),
+    ("OpenWeatherMap", _geocode_openweather),
+])
+
+def get_coordinates(location: str):
+    return GEOCODER.call(location)
+
 # ------------------------------
-# 天気取得（5日間: OpenWeather / 6日以降: 月平均）
-# 6日目以降は max/min を「xx.x°C (月平均)」の文字列で保証
+# 天気取得（指定日付ごと: OpenWeather 5日予報 / それ以外は月平均）
+# 月平均の日は max/min を「xx.x°C (月平均)」の文字列で保証
 # ------------------------------
-def get_weather(location: str, days: int = 7):
+def _climate_condition(avg_precip):
+    # 降水量に基づいて「天気の傾向」を決める
+    if avg_precip is None:
+        return "平均的な気候"
+    elif avg_precip < 50:
+        return "晴れが多い"
+    elif avg_precip < 150:
+        return "曇りがち"
+    return "雨が多い"
+
+def openweather_horizon():
+    """OpenWeather の5日予報でカバーされる日付（今日〜5日後）"""
+    today = datetime.utcnow().date()
+    return [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(6)]
+
+def get_weather_for_dates(lat: float, lon: float, dates):
+    """dates（YYYY-MM-DD のリスト）の天気を {date: forecast} で返す"""
     api_key = os.getenv("OPENWEATHER_API_KEY")
-    coords = get_coordinates(location)
-    if not coords:
-        return {"error": f"座標を取得できませんでした: {location}"}
-    lat, lon = coords["lat"], coords["lon"]
-
-    forecasts = []
+    results = {}
 
-    # --- ① OpenWeather (5日間まで) ---
-    try:
-        url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&units=metric&lang=ja&appid={api_key}"
-        resp = requests.get(url, timeout=10).json()
-        if "list" not in resp:
-            return {"error": "天気データを取得できませんでした"}
-
-        daily_data = {}
-        for entry in resp["list"]:
-            dt = datetime.utcfromtimestamp(entry["dt"])
-            date_str = dt.strftime("%Y-%m-%d")
-            temp = entry["main"]["temp"]
-            condition = entry["weather"][0]["description"]
-
-            if date_str not in daily_data:
-                daily_data[date_str] = {"temps": [], "conditions": []}
-            daily_data[date_str]["temps"].append(temp)
-            daily_data[date_str]["conditions"].append(condition)
-
-        for idx, (date_str, d) in enumerate(sorted(daily_data.items())):
-            if idx >= min(days, 5):
-                break
-            max_t = max(d["temps"])
-            min_t = min(d["temps"])
-            condition = max(set(d["conditions"]), key=d["conditions"].count)
-            forecasts.append({
-                "day": f"Day {idx+1}",
-                "date": date_str,
-                "max_temp": f"{max_t:.1f}°C",
-                "min_temp": f"{min_t:.1f}°C",
-                "condition": condition,
-            })
-    except Exception as e:
-        return {"error": f"OpenWeather天気取得失敗: {e}"}
+    # --- ① OpenWeather (5日間まで、範囲内の日がなければ呼ばない) ---
+    horizon = openweather_horizon()
+    if any(d in horizon for d in dates):
+        try:
+            url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&units=metric&lang=ja&appid={api_key}"
+            resp = requests.get(url, timeout=10).json()
+            if "list" not in resp:
+                raise ValueError("天気データを取得できませんでした")
+
+            daily_data = {}
+            for entry in resp["list"]:
+                dt = datetime.utcfromtimestamp(entry["dt"])
+                date_str = dt.strftime("%Y-%m-%d")
+                temp = entry["main"]["temp"]
+                condition = entry["weather"][0]["description"]
+
+                # 3時間ごとの降水量（雨・雪）を日ごとに合算
+                precip = entry.get("rain", {}).get("3h", 0) + entry.get("snow", {}).get("3h", 0)
+
+                if date_str not in daily_data:
+                    daily_data[date_str] = {"temps": [], "conditions": [], "precip": 0.0}
+                daily_data[date_str]["temps"].append(temp)
+                daily_data[date_str]["conditions"].append(condition)
+                daily_data[date_str]["precip"] += precip
+
+            for date_str in dates:
+                d = daily_data.get(date_str)
+                if not d:
+                    continue
+                max_t = max(d["temps"])
+                min_t = min(d["temps"])
+                condition = max(set(d["conditions"]), key=d["conditions"].count)
+                results[date_str] = {
+                    "date": date_str,
+                    "max_temp": f"{max_t:.1f}°C",
+                    "min_temp": f"{min_t:.1f}°C",
+                    "condition": condition,
+                    "precipitation": round(d["precip"], 1),
+                    "source": "OpenWeather",
+                }
+        except Exception as e:
+            # 取得できなかった日は ② の月平均で補完する
+            print("⚠️ OpenWeather天気取得失敗:", e)
 
-    # --- ② 6日目以降 (月別平均気候で補完) ---
-    if days > 5:
+    # --- ② 予報で埋まらなかった日 (月別平均気候で補完) ---
+    missing = [d for d in dates if d not in results]
+    if missing:
         try:
             url = (
                 f"https://climate-api.open-meteo.com/v1/climate?"
@@ -168,40 +197,38 @@ def get_weather(location: str, days: int = 7):
                     "avg_precip": precips[i],
                 }
 
-            for idx in range(5, days):
-                future_date = (datetime.utcnow().date() + timedelta(days=idx)).strftime("%Y-%m-%d")
-                future_month = int(future_date.split("-")[1])
-
-                avg_max = month_avg.get(future_month, {}).get("avg_max")
-                avg_min = month_avg.get(future_month, {}).get("avg_min")
-                avg_precip = month_avg.get(future_month, {}).get("avg_precip")
-
-                # 降水量に基づいて「天気の傾向」を決める
-                if avg_precip is None:
-                    condition = "平均的な気候"
-                elif avg_precip < 50:
-                    condition = "晴れが多い"
-                elif avg_precip < 150:
-                    condition = "曇りがち"
-                else:
-                    condition = "雨が多い"
-
-                forecasts.append({
-                    "day": f"Day {idx+1}",
-                    "date": future_date,
-                    "max_temp": f"{(avg_max if avg_max is not None else float('nan')):.1f}°C (月平均)" if avg_max is not None else "N/A",
-                    "min_temp": f"{(avg_min if avg_min is not None else float('nan')):.1f}°C (月平均)" if avg_min is not None else "N/A",
-                    "condition": condition,
-                })
+            for date_str in missing:
+                month = int(date_str.split("-")[1])
+                avg_max = month_avg.get(month, {}).get("avg_max")
+                avg_min = month_avg.get(month, {}).get("avg_min")
+                avg_precip = month_avg.get(month, {}).get("avg_precip")
+
+                results[date_str] = {
+                    "date": date_str,
+                    "max_temp": f"{avg_max:.1f}°C (月平均)" if avg_max is not None else "N/A",
+                    "min_temp": f"{avg_min:.1f}°C (月平均)" if avg_min is not None else "N/A",
+                    "condition": _climate_condition(avg_precip),
+                    "source": "Climate",
+                }
         except Exception as e:
-            forecasts.append({"error": f"月別平均気候データ取得失敗: {e}"})
+            results["error"] = f"月別平均気候データ取得失敗: {e}"
+
+    return results
 
-    return {"location": location, "forecasts": forecasts}
+def build_forecasts(dates, by_date: dict):
+    """{date: forecast} を Day 番号付きのリストに並べる"""
+    forecasts = []
+    for idx, date_str in enumerate(dates):
+        if date_str in by_date:
+            forecasts.append({"day": f"Day {idx+1}", **by_date[date_str]})
+    if "error" in by_date:
+        forecasts.append({"error": by_date["error"]})
+    return forecasts
 
 # ------------------------------
 # 服装アドバイスをまとめて生成（LLM一括）
 # ------------------------------
-def generate_clothing_advice_bulk(forecasts):
+def _clothing_advice_via_llm(forecasts):
     # LLM 入力用：生値（数値・単位付き文字列）をそのまま渡す
     data = [
         {
@@ -236,7 +263,7 @@ def generate_clothing_advice_bulk(forecasts):
                 f["advice"] = "服装アドバイスは生成できませんでした。"
             elif f["day"] in advice_map:
                 f["advice"] = advice_map[f["day"]]
-            else:
+            elif "advice" not in f:
                 f["advice"] = "服装アドバイスは生成できませんでした。"
     except Exception as e:
         print("⚠️ 服装アドバイス生成失敗:", e)
@@ -246,13 +273,59 @@ def generate_clothing_advice_bulk(forecasts):
 
     return forecasts
 
+# ------------------------------
+# 服装アドバイス生成（mode: llm / local / hybrid）
+# local: ルールのみ（LLM 呼び出しなし）
+# hybrid: ルールで全日を埋め、猛暑・氷点下・大きな寒暖差・荒天など特殊な日だけ LLM に回す
+# 月平均の日は precipitation を持たない（降水傾向は condition の「雨が多い」等で判定）
+# ------------------------------
+ADVICE_MODES = ("llm", "local", "hybrid")
+
+def generate_clothing_advice_bulk(forecasts, mode: str = "llm"):
+    if mode not in ADVICE_MODES:
+        raise ValueError(f"未対応の mode です: {mode}（{' / '.join(ADVICE_MODES)}）")
+    if mode == "llm":
+        return _clothing_advice_via_llm(forecasts)
+
+    unusual = []
+    for f in forecasts:
+        if "error" in f:
+            f["advice"] = "服装アドバイスは生成できませんでした。"
+            continue
+        args = (f.get("max_temp"), f.get("min_temp"), f.get("condition"), f.get("precipitation"))
+        advice = local_clothing_advice(*args)
+        if advice:
+            f["advice"] = advice
+        if mode == "hybrid" and (not advice or is_unusual_day(*args)):
+            unusual.append(f)
+        elif not advice:
+            f["advice"] = "服装アドバイスは生成できませんでした。"
+
+    if unusual:
+        try:
+            _clothing_advice_via_llm(unusual)
+        except Exception as e:
+            # LLM が使えなくてもルールベースのアドバイスで続行する
+            print("⚠️ 服装アドバイス生成失敗（ルールベースのアドバイスを使用）:", e)
+            for f in unusual:
+                if "advice" not in f:
+                    f["advice"] = "服装アドバイスは生成できませんでした。"
+    return forecasts
+
 # ------------------------------
 # 観光スポット取得（ChatGPTフォールバック）
 # ------------------------------
-def get_tourist_spots(location: str, limit: int = 12):
+def get_tourist_spots(location: str, limit: int = 12, days: int = None):
+    # 日ごとに違う料理・スポットを割り振れるよう、日数に応じて件数を増やす
+    dish_count = ""
+    if days:
+        limit = max(limit, days * 3)
+        dish_count = f"地元料理は日ごとに違うものを出せるよう、少なくとも{days}件含めてください。"
     q = (
         f"{location}の代表的な観光スポットと、夜に楽しめるナイトライフや地元料理を{limit}件、"
         "名前と簡単な説明をJSONで返してください。"
+        f"{dish_count}"
+        "トップレベルキーは '観光スポット', 'ナイトライフ', '地元料理' とし、各要素に '名前' と '説明' を含めてください。"
     )
     resp = client.chat.completions.create(
         model="gpt-4o-mini",
@@ -265,11 +338,181 @@ def get_tourist_spots(location: str, limit: int = 12):
         return {"error": "観光スポット情報を取得できませんでした"}
 
 # ------------------------------
-# メイン処理
+# 旅行プラン生成（一括: Day1〜DayN を1回の出力で生成）
 # ------------------------------
-if __name__ == "__main__":
-    user_input = input("旅行について、場所と期間を入力してください: ")
+PLAN_SYSTEM_PROMPT = (
+    "あなたは旅行プランナーです。以下の情報をもとに、Day1〜DayNの旅行プランをカレンダー形式で作成してください。"
+    "各Dayの冒頭に天気情報を載せ、その気温と天気に基づいて服装アドバイスを必ず書いてください。"
+    "午前・午後・夜に分けて観光やアクティビティを提案してください。"
+    "夜はナイトライフや夜景に加えて、その土地の代表的な地元料理を日ごとに違うものを提案してください。"
+    "初日は到着時刻を考慮し、それ以前は活動を入れないでください。"
+    "最終日は出発時刻を考慮し、搭乗1時間前には空港チェックインを行う必要があるため、その時間以降は活動を入れないでください。"
+    "宿泊ホテル情報がある場合、各日の最初に『ホテル出発』、最後に『ホテルに戻る』を必ず含めてください。"
+    "最後に全体の持ち物リストをまとめてください。"
+)
+
+def generate_plan_single(user_input: str, weather_text: str, hotel_info: dict, combined: dict):
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": PLAN_SYSTEM_PROMPT},
+            {"role": "user", "content": f"旅行リクエスト: {user_input}\n\n{weather_text}\n宿泊ホテル: {hotel_info['name']} ({hotel_info['address']})"},
+            {"role": "function", "name": "get_travel_info", "content": json.dumps(combined, ensure_ascii=False)},
+        ]
+    )
+    return resp.choices[0].message.content
+
+# ------------------------------
+# 旅行プラン生成（並列: 日ごとに同時生成 → 結合）
+# 長期旅行でも所要時間が 1〜2 日分程度に収まる
+# ------------------------------
+def _spot_names(items):
+    names = []
+    for it in items:
+        if isinstance(it, dict):
+            name = it.get("名前") or it.get("name")
+            if name:
+                names.append(str(name))
+        elif isinstance(it, str):
+            names.append(it)
+    return names
+
+def _is_dish_category(category: str):
+    return any(k in category for k in ("料理", "グルメ", "食")) or any(k in category.lower() for k in ("food", "dish"))
+
+def allocate_spots_by_day(spots: dict, days: int):
+    """観光スポット・ナイトライフ・料理をカテゴリごとに日へ割り振る（重複防止用）"""
+    allocation = [{} for _ in range(days)]
+    if not isinstance(spots, dict) or days <= 0:
+        return allocation
+
+    # {"spots": {...}} のようにネストしている場合は1段下を見る
+    if len(spots) == 1 and isinstance(next(iter(spots.values())), dict):
+        spots = next(iter(spots.values()))
+
+    for category, items in spots.items():
+        if not isinstance(items, list):
+            continue
+        for i, name in enumerate(_spot_names(items)):
+            allocation[i % days].setdefault(category, []).append(name)
+    return allocation
+
+def build_plan_context(user_input: str, info: dict, hotel_info: dict):
+    """全日程で共有するコンパクトなコンテキスト"""
+    return (
+        f"旅行リクエスト: {user_input}\n"
+        f"旅行先: {info.get('location')} / 日数: {info.get('days')}\n"
+        f"到着: {info.get('arrival_time')} / 出発: {info.get('departure_time')}\n"
+        f"宿泊ホテル: {hotel_info['name']} ({hotel_info['address']})"
+    )
+
+def _format_allocation(day_alloc: dict):
+    if not day_alloc:
+        return "なし"
+    return " / ".join(f"{cat}: {', '.join(names)}" for cat, names in day_alloc.items())
+
+def generate_day_plan(context: str, day_index: int, days: int, forecast, day_alloc: dict, used_elsewhere: list, info: dict):
+    day_no = day_index + 1
+    dishes = [n for cat, names in day_alloc.items() if _is_dish_category(cat) for n in names]
+    rules = [
+        f"あなたは旅行プランナーです。全{days}日間の旅行のうち Day{day_no} のプランだけを作成してください。",
+        "冒頭に天気情報を載せ、その気温と天気に基づいて服装アドバイスを必ず書いてください。",
+        "午前・午後・夜に分けて観光やアクティビティを提案してください。",
+        "観光スポット・ナイトライフ・地元料理は、この日に割り当てた候補の中から選んでください。",
+        "他の日に割り当てたものは、地元料理が日ごとに違うものになるよう絶対に使わないでください。",
+        "最初に『ホテル出発』、最後に『ホテルに戻る』を必ず含めてください。",
+        "持ち物リストは書かないでください。",
+    ]
+    if dishes:
+        rules.append(f"夜はナイトライフや夜景に加えて、地元料理として『{'』『'.join(dishes)}』を提案してください。")
+    else:
+        rules.append("この日に割り当てた地元料理はないため、特定の名物料理は挙げず、割り当てた候補の範囲で夜の過ごし方を提案してください。")
+    if day_index == 0:
+        rules.append(f"この日は初日です。到着時刻（{info.get('arrival_time')}）以前は活動を入れないでください。")
+    if day_index == days - 1:
+        rules.append(
+            f"この日は最終日です。出発時刻（{info.get('departure_time')}）を考慮し、"
+            "搭乗1時間前には空港チェックインを行う必要があるため、その時間以降は活動を入れないでください。"
+        )
+
+    weather_line = "天気情報なし"
+    if forecast and "error" not in forecast:
+        weather_line = (
+            f"{forecast.get('date', '')}: 最高 {forecast.get('max_temp', 'N/A')} / 最低 {forecast.get('min_temp', 'N/A')} / "
+            f"天気: {forecast.get('condition', '不明')} / アドバイス: {forecast.get('advice', '服装アドバイスなし')}"
+        )
+
+    user_content = (
+        f"{context}\n\n"
+        f"Day{day_no} の天気: {weather_line}\n"
+        f"Day{day_no} で優先して使う候補: {_format_allocation(day_alloc)}\n"
+        f"他の日で使うため提案しないもの: {', '.join(used_elsewhere) if used_elsewhere else 'なし'}"
+    )
+
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "".join(rules)},
+            {"role": "user", "content": user_content},
+        ]
+    )
+    return resp.choices[0].message.content
+
+def generate_packing_list(context: str, weather_text: str):
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "あなたは旅行プランナーです。以下の旅行情報と天気をもとに、旅行全体の持ち物リストを箇条書きでまとめてください。"},
+            {"role": "user", "content": f"{context}\n\n{weather_text}"},
+        ]
+    )
+    return resp.choices[0].message.content
+
+PLAN_MODES = ("single", "parallel", "auto")
+
+def generate_plan_parallel(user_input: str, info: dict, weather_text: str, hotel_info: dict, result_weather: dict, result_spots: dict, max_workers: int = 8):
+    days = parse_days(info.get("days"))
+    context = build_plan_context(user_input, info, hotel_info)
+    forecasts = result_weather.get("forecasts", []) if isinstance(result_weather, dict) else []
+    # 欠損日やエラー要素があっても位置がずれないよう Day 番号で引く
+    forecast_by_day = {f["day"]: f for f in forecasts if "day" in f}
+    allocation = allocate_spots_by_day(result_spots.get("spots", {}), days)
+
+    def used_elsewhere(day_index):
+        return [n for i, a in enumerate(allocation) if i != day_index for names in a.values() for n in names]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        day_futures = [
+            ex.submit(
+                generate_day_plan, context, i, days,
+                forecast_by_day.get(f"Day {i+1}"),
+                allocation[i], used_elsewhere(i), info,
+            )
+            for i in range(days)
+        ]
+        packing_future = ex.submit(generate_packing_list, context, weather_text)
+
+        sections = []
+        for i, fut in enumerate(day_futures):
+            try:
+                sections.append(fut.result())
+            except Exception as e:
+                print(f"⚠️ Day{i+1} のプラン生成失敗:", e)
+                sections.append(f"Day{i+1}: プランを生成できませんでした。")
+        try:
+            packing = packing_future.result()
+        except Exception as e:
+            print("⚠️ 持ち物リスト生成失敗:", e)
+            packing = "持ち物リストを生成できませんでした。"
 
+    return "\n\n---\n\n".join(sections) + "\n\n---\n\n### 持ち物リスト\n" + packing
+
+# ------------------------------
+# パイプラインを DAG として定義（ステージ単位でメモ化）
+# ホテル変更 → ホテル関連とプランのみ再計算
+# 日程変更 → 変わった日の天気・服装アドバイスとプランのみ再計算
+# ------------------------------
+def extract_trip_info(user_input: str):
     # location, days, arrival_time, departure_time を抽出
     extract = client.chat.completions.create(
         model="gpt-4o-mini",
@@ -287,28 +530,235 @@ if __name__ == "__main__":
         info["arrival_time"] = "初日 14:00"  # デフォルト到着時刻
     if not info.get("departure_time"):
         info["departure_time"] = "最終日 12:00"  # デフォルト出発時刻
+    return info
 
-    print("抽出情報:", info)
+def rank_hotels(candidates):
+    candidates = deduplicate_hotels([dict(c) for c in candidates])
+    if not candidates:
+        return []
 
-    # ホテル候補を取得して選択
-    hotel_info = None
-    while not hotel_info:
-        hotel_name = input("宿泊ホテル名を入力してください: ")
-        candidates = get_hotel_candidates_via_llm(hotel_name, info["location"])
-        if not candidates or len(candidates) == 0:
-            print("⚠️ 十分に一致するホテル候補が見つかりませんでした。もう一度入力してください。")
-            continue
+    # 第1候補を基準に距離とスコアを計算
+    base = candidates[0]
+    for c in candidates:
+        dist = haversine(base["lat"], base["lon"], c["lat"], c["lon"])
+        c["distance_km"] = round(dist, 2)
+        c["final_score"] = round(c["match_score"] - (dist / 20), 3)
+
+    return sorted(candidates, key=lambda x: x["final_score"], reverse=True)
+
+def parse_date(value):
+    """'2025-10-15T10:00' / '2025-10-15 10:00' → date（解釈できなければ None）"""
+    try:
+        return datetime.fromisoformat(str(value or "").strip()[:10]).date()
+    except ValueError:
+        return None
+
+def parse_days(value, default: int = 7):
+    """5 / '5' / '5日' → 5（数字がなければ default）"""
+    m = re.search(r"\d+", str(value if value is not None else ""))
+    return int(m.group()) if m and int(m.group()) > 0 else default
+
+def shift_date(value, days: int):
+    """'2025-10-15 10:00' の日付部分だけを days 日ずらす（日付として解釈できなければそのまま）"""
+    d = parse_date(value)
+    if d is None:
+        return value
+    value = str(value).strip()
+    return (d + timedelta(days=days)).strftime("%Y-%m-%d") + value[10:]
+
+def resolve_trip(info: dict, override: dict):
+    """抽出結果に日程変更を重ね、到着日・出発日・日数が食い違わないよう揃える"""
+    override = {k: v for k, v in override.items() if v}
+    trip = {**info, **override}
+    arrival = parse_date(trip.get("arrival_time"))
+
+    if "arrival_time" in override and "departure_time" not in override:
+        # 到着日だけ変更 → 出発日も同じ日数だけずらす
+        old_arrival = parse_date(info.get("arrival_time"))
+        if old_arrival and arrival:
+            trip["departure_time"] = shift_date(info.get("departure_time"), (arrival - old_arrival).days)
+
+    departure = parse_date(trip.get("departure_time"))
+    if "departure_time" in override and "days" not in override:
+        # 出発日を変更（日数は未指定） → 到着日〜出発日から日数を決め直す
+        if arrival and departure and departure >= arrival:
+            trip["days"] = (departure - arrival).days + 1
+    elif "days" in override and arrival and departure:
+        # 日数を変更 → 出発日を到着日＋日数に合わせる
+        trip["departure_time"] = shift_date(trip["departure_time"], (arrival - departure).days + parse_days(override["days"]) - 1)
+
+    trip["days"] = parse_days(trip.get("days"))
+    return trip
+
+def trip_dates(trip: dict):
+    """到着日（解釈できなければ今日）から days 日分の日付リスト"""
+    start = parse_date(trip.get("arrival_time")) or datetime.utcnow().date()
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(parse_days(trip.get("days")))]
+
+def format_weather_text(result_weather: dict):
+    weather_text = ""
+    if "forecasts" in result_weather:
+        weather_text = f"📅 週間天気 ({result_weather.get('location','不明')}):\n"
+        for f in result_weather["forecasts"]:
+            if "error" in f:
+                continue
+            # max/min はすでに文字列（xx.x°C or xx.x°C (月平均)）として統一済み
+            max_t = f.get('max_temp', 'N/A')
+            min_t = f.get('min_temp', 'N/A')
+            condition = f.get('condition', '不明')
+            advice = f.get('advice', '服装アドバイスなし')
+            date = f.get('date', '')
+            weather_text += (
+                f"{f['day']} ({date}): "
+                f"最高 {max_t} / 最低 {min_t} / 天気: {condition} / アドバイス: {advice}\n"
+            )
+    return weather_text
+
+def build_travel_graph(user_input: str):
+    g = StageGraph()
+    g.add_input("user_input", user_input)
+    g.add_input("schedule_override", {})
+    g.add_input("hotel_name", None)
+    g.add_input("hotel", None)
+
+    weather_cache = {}  # (lat, lon, date) -> forecast
+    advice_cache = {}   # (date, max, min, condition) -> advice
+
+    @g.stage("info", ["user_input"])
+    def _info(user_input):
+        return extract_trip_info(user_input)
+
+    @g.stage("trip", ["info", "schedule_override"])
+    def _trip(info, schedule_override):
+        return resolve_trip(info, schedule_override)
+
+    @g.stage("location", ["info"])
+    def _location(info):
+        return info["location"]
+
+    @g.stage("dates", ["trip"])
+    def _dates(trip):
+        return trip_dates(trip)
+
+    @g.stage("coords", ["location"])
+    def _coords(location):
+        coords = get_coordinates(location)
+        # 取得失敗はメモに残さず、次回も座標取得からやり直す
+        return coords if coords else NoCache(None)
+
+    @g.stage("weather", ["location", "coords", "dates"])
+    def _weather(location, coords, dates):
+        if not coords:
+            return NoCache({"error": f"座標を取得できませんでした: {location}"})
+        lat, lon = coords["lat"], coords["lon"]
+
+        # 未取得の日だけ取得する
+        fetch_error = None
+        missing = [d for d in dates if (lat, lon, d) not in weather_cache]
+        by_date = {}
+        if missing:
+            print(f"🌤 天気取得: {len(missing)}日分（キャッシュ済み {len(dates) - len(missing)}日分）")
+            fetched = get_weather_for_dates(lat, lon, missing)
+            fetch_error = fetched.pop("error", None)
+            horizon = openweather_horizon()
+            for d, f in fetched.items():
+                by_date[d] = f
+                # 予報範囲内を月平均で埋めた日はキャッシュせず、次回は予報を取り直す
+                if f.get("source") == "OpenWeather" or d not in horizon:
+                    weather_cache[(lat, lon, d)] = f
+
+        for d in dates:
+            if (lat, lon, d) in weather_cache:
+                by_date[d] = weather_cache[(lat, lon, d)]
+        if fetch_error:
+            by_date["error"] = fetch_error
+        result = {"location": location, "forecasts": build_forecasts(dates, by_date)}
+        # 取り直しが必要な日が残る場合はステージ結果もメモに残さない
+        if fetch_error or any((lat, lon, d) not in weather_cache for d in dates):
+            return NoCache(result)
+        return result
+
+    @g.stage("advice", ["weather"])
+    def _advice(weather):
+        if "forecasts" not in weather:
+            return weather
+
+        def key(f):
+            return (f.get("date"), f.get("max_temp"), f.get("min_temp"), f.get("condition"))
+
+        forecasts = [dict(f) for f in weather["forecasts"]]
+        pending = [f for f in forecasts if "error" not in f and key(f) not in advice_cache]
+        # 服装アドバイスを未生成の日だけ一括生成して forecasts にマージ
+        if pending:
+            mode = os.getenv("ADVICE_MODE", "hybrid")
+            if mode not in ADVICE_MODES:
+                print(f"⚠️ ADVICE_MODE={mode} は未対応のため hybrid で生成します（{' / '.join(ADVICE_MODES)}）")
+                mode = "hybrid"
+            for f in generate_clothing_advice_bulk(pending, mode=mode):
+                advice_cache[key(f)] = f["advice"]
+        for f in forecasts:
+            if "error" not in f:
+                f["advice"] = advice_cache.get(key(f), "服装アドバイスは生成できませんでした。")
+        return {**weather, "forecasts": forecasts}
+
+    @g.stage("days", ["trip"])
+    def _days(trip):
+        return parse_days(trip.get("days"))
+
+    @g.stage("spots", ["location", "days"])
+    def _spots(location, days):
+        return get_tourist_spots(location, limit=12, days=days)
+
+    @g.stage("hotel_candidates", ["hotel_name", "location"])
+    def _hotel_candidates(hotel_name, location):
+        if not hotel_name:
+            return []
+        candidates = get_hotel_candidates_via_llm(hotel_name, location)
+        # 候補なしはメモに残さず、同じ名前で再入力されたら LLM に聞き直す
+        return candidates if candidates else NoCache([])
+
+    @g.stage("hotel_ranking", ["hotel_candidates"])
+    def _hotel_ranking(hotel_candidates):
+        return rank_hotels(hotel_candidates)
+
+    @g.stage("plan", ["user_input", "trip", "advice", "spots", "hotel"])
+    def _plan(user_input, trip, advice, spots, hotel):
+        combined = {
+            "weather": advice,
+            "spots": spots,
+            "arrival_time": trip.get("arrival_time"),
+            "departure_time": trip.get("departure_time"),
+            "hotel": hotel
+        }
+        print("Function result:", json.dumps(combined, ensure_ascii=False, indent=2))
+
+        weather_text = format_weather_text(advice)
 
-        candidates = deduplicate_hotels(candidates)
+        # ------------------------------
+        # LLMで旅行プランを生成
+        # PLAN_MODE: single（一括） / parallel（日ごと並列） / auto（4日以上で並列）
+        # ------------------------------
+        plan_mode = os.getenv("PLAN_MODE", "auto")
+        if plan_mode not in PLAN_MODES:
+            print(f"⚠️ PLAN_MODE={plan_mode} は未対応のため auto で生成します（{' / '.join(PLAN_MODES)}）")
+            plan_mode = "auto"
+        if plan_mode == "auto":
+            plan_mode = "parallel" if parse_days(trip.get("days")) >= 4 else "single"
 
-        # 第1候補を基準に距離とスコアを計算
-        base = candidates[0]
-        for c in candidates:
-            dist = haversine(base["lat"], base["lon"], c["lat"], c["lon"])
-            c["distance_km"] = round(dist, 2)
-            c["final_score"] = round(c["match_score"] - (dist / 20), 3)
+        if plan_mode == "parallel":
+            return generate_plan_parallel(user_input, trip, weather_text, hotel, advice, spots)
+        return generate_plan_single(user_input, weather_text, hotel, combined)
 
-        candidates = sorted(candidates, key=lambda x: x["final_score"], reverse=True)
+    return g
+
+def choose_hotel(g: StageGraph):
+    # ホテル候補を取得して選択
+    while True:
+        g.set_input("hotel_name", input("宿泊ホテル名を入力してください: "))
+        candidates = g.get("hotel_ranking")
+        if not candidates:
+            print("⚠️ 十分に一致するホテル候補が見つかりませんでした。もう一度入力してください。")
+            continue
 
         print("\n候補リスト（類似度＋距離でソート、重複除去後）:")
         for i, c in enumerate(candidates, start=1):
@@ -322,68 +772,64 @@ if __name__ == "__main__":
             continue
 
         if choice == 0:
+            # 再入力では同じ名前でも LLM に聞き直す
+            g.invalidate("hotel_candidates")
             continue
         if 1 <= choice <= len(candidates):
             hotel_info = candidates[choice-1]
+            print(f"\n✅ 選択されたホテル: {hotel_info['name']} - {hotel_info['address']}")
+            return hotel_info
 
-    print(f"\n✅ 選択されたホテル: {hotel_info['name']} - {hotel_info['address']}")
+# ------------------------------
+# メイン処理
+# ------------------------------
+if __name__ == "__main__":
+    user_input = input("旅行について、場所と期間を入力してください: ")
 
-    # 天気 & 観光
-    result_weather = get_weather(info["location"], days=int(info.get("days", 7)))
-    # 服装アドバイスを一括生成して forecasts にマージ
-    if "forecasts" in result_weather:
-        result_weather["forecasts"] = generate_clothing_advice_bulk(result_weather["forecasts"])
-    result_spots = get_tourist_spots(info["location"], limit=12)
-
-    combined = {
-        "weather": result_weather,
-        "spots": result_spots,
-        "arrival_time": info.get("arrival_time"),
-        "departure_time": info.get("departure_time"),
-        "hotel": hotel_info
-    }
-    print("Function result:", json.dumps(combined, ensure_ascii=False, indent=2))
+    graph = build_travel_graph(user_input)
+    print("抽出情報:", graph.get("info"))
 
-    # ------------------------------
-    # 天気を整形して渡す（Day N まで）
-    # ------------------------------
-    weather_text = ""
-    if "forecasts" in result_weather:
-        weather_text = f"📅 週間天気 ({result_weather.get('location','不明')}):\n"
-        for f in result_weather["forecasts"]:
-            # max/min はすでに文字列（xx.x°C or xx.x°C (月平均)）として統一済み
-            max_t = f.get('max_temp', 'N/A')
-            min_t = f.get('min_temp', 'N/A')
-            condition = f.get('condition', '不明')
-            advice = f.get('advice', '服装アドバイスなし')
-            date = f.get('date', '')
-            weather_text += (
-                f"{f['day']} ({date}): "
-                f"最高 {max_t} / 最低 {min_t} / 天気: {condition} / アドバイス: {advice}\n"
-            )
+    graph.set_input("hotel", choose_hotel(graph))
+    print("\n💡 旅行プラン回答:\n", graph.get("plan"))
 
     # ------------------------------
-    # LLMで旅行プランを生成
+    # 変更を受け付けて差分だけ再計算
     # ------------------------------
-    followup = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "あなたは旅行プランナーです。以下の情報をもとに、Day1〜DayNの旅行プランをカレンダー形式で作成してください。"
-                    "各Dayの冒頭に天気情報を載せ、その気温と天気に基づいて服装アドバイスを必ず書いてください。"
-                    "午前・午後・夜に分けて観光やアクティビティを提案してください。"
-                    "夜はナイトライフや夜景に加えて、その土地の代表的な地元料理を日ごとに違うものを提案してください。"
-                    "初日は到着時刻を考慮し、それ以前は活動を入れないでください。"
-                    "最終日は出発時刻を考慮し、搭乗1時間前には空港チェックインを行う必要があるため、その時間以降は活動を入れないでください。"
-                    "宿泊ホテル情報がある場合、各日の最初に『ホテル出発』、最後に『ホテルに戻る』を必ず含めてください。"
-                    "最後に全体の持ち物リストをまとめてください。"
-                ),
-            },
-            {"role": "user", "content": f"旅行リクエスト: {user_input}\n\n{weather_text}\n宿泊ホテル: {hotel_info['name']} ({hotel_info['address']})"},
-            {"role": "function", "name": "get_travel_info", "content": json.dumps(combined, ensure_ascii=False)},
-        ]
-    )
-
-    print("\n💡 旅行プラン回答:\n", followup.choices[0].message.content)
+    while True:
+        cmd = input("\n変更しますか？（h: ホテル変更 / d: 日程変更 / Enter: 終了）: ").strip()
+        if cmd == "h":
+            graph.set_input("hotel", choose_hotel(graph))
+        elif cmd == "d":
+            trip = graph.get("trip")
+            override = dict(graph.get("schedule_override"))
+            for k, label in [("arrival_time", "到着日時"), ("departure_time", "出発日時")]:
+                value = input(f"新しい{label}（現在: {trip.get(k)} / Enter で変更なし）: ").strip()
+                if value:
+                    override[k] = value
+            days = None
+            while True:
+                value = input(f"新しい日数（現在: {trip.get('days')} / Enter で変更なし）: ").strip()
+                if not value:
+                    break
+                days = parse_days(value, default=None)
+                if days:
+                    break
+                print("日数は数字で入力してください（例: 3）。")
+            previous = graph.get("schedule_override")
+            if days:
+                # 日数を指定したら出発日は到着日＋日数から決める
+                override["days"] = days
+                if override.get("departure_time") == previous.get("departure_time"):
+                    override.pop("departure_time", None)
+            elif override.get("departure_time") != previous.get("departure_time"):
+                # 出発日時だけ変えた場合は出発日から日数を決め直す
+                override.pop("days", None)
+            elif override.get("arrival_time") != previous.get("arrival_time") and override.get("departure_time"):
+                # 到着日だけ変えた場合は、以前変更した出発日も同じ日数ずらす
+                old_arrival, new_arrival = parse_date(trip.get("arrival_time")), parse_date(override["arrival_time"])
+                if old_arrival and new_arrival:
+                    override["departure_time"] = shift_date(override["departure_time"], (new_arrival - old_arrival).days)
+            graph.set_input("schedule_override", override)
+        else:
+            break
+        print("\n💡 旅行プラン回答:\n", graph.get("plan"))
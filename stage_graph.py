@@ -0,0 +1,68 @@
+import hashlib, json
+
+# ------------------------------
+# ステージ DAG（名前付きステージ＋宣言的な入力＋結果メモ化）
+# 入力値のフィンガープリントが前回と同じステージは再計算せず再利用する
+# 上流が再計算されても結果が同じなら下流はそのまま再利用される
+# ------------------------------
+def fingerprint(value):
+    raw = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class NoCache:
+    """ステージがこれで包んで返した結果はメモに残さない（失敗時など、次回も再計算させたい場合）"""
+    def __init__(self, value):
+        self.value = value
+
+class StageGraph:
+    def __init__(self, verbose: bool = True):
+        self._inputs = {}    # 外部入力: name -> value
+        self._stages = {}    # ステージ: name -> (inputs, fn)
+        self._memo = {}      # name -> (入力フィンガープリント, 結果)
+        self.verbose = verbose
+
+    def add_input(self, name: str, value=None):
+        self._inputs[name] = value
+
+    def set_input(self, name: str, value):
+        """外部入力を更新する（下流は次回 get 時に入力の変化を検知して再計算）"""
+        if name not in self._inputs:
+            raise KeyError(f"未定義の入力です: {name}")
+        self._inputs[name] = value
+
+    def stage(self, name: str, inputs=()):
+        """デコレータ: fn(**inputs) をステージとして登録する"""
+        def register(fn):
+            for dep in inputs:
+                if dep not in self._inputs and dep not in self._stages:
+                    raise KeyError(f"{name} の入力 {dep} が未定義です（先に登録してください）")
+            self._stages[name] = (tuple(inputs), fn)
+            return fn
+        return register
+
+    def invalidate(self, name: str):
+        """name のメモを破棄し、次回 get で必ず再計算させる（下流は結果の変化で判定）"""
+        self._memo.pop(name, None)
+
+    def get(self, name: str):
+        if name in self._inputs:
+            return self._inputs[name]
+        if name not in self._stages:
+            raise KeyError(f"未定義のステージです: {name}")
+
+        deps, fn = self._stages[name]
+        kwargs = {dep: self.get(dep) for dep in deps}
+        key = fingerprint(kwargs)
+
+        memo = self._memo.get(name)
+        if memo and memo[0] == key:
+            return memo[1]
+
+        if self.verbose:
+            print(f"▶ {name}: 実行")
+        result = fn(**kwargs)
+        if isinstance(result, NoCache):
+            self._memo.pop(name, None)
+            return result.value
+        self._memo[name] = (key, result)
+        return result
@@ -1,7 +1,11 @@
-import requests
+import os, sys, requests
 from datetime import datetime, timedelta
 from geopy.geocoders import Nominatim
 
+# hedging.py はリポジトリ直下の1ファイルを共有する
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hedging import HedgedChain
+
 # 天気コードを日本語に変換する辞書
 WEATHER_CODE_JP = {
     0: "快晴", 1: "晴れ", 2: "一部曇り", 3: "曇り",
@@ -13,13 +17,32 @@ WEATHER_CODE_JP = {
     95: "雷雨（弱～中）", 96: "雷雨とひょう（弱い）", 99: "雷雨とひょう（強い）"
 }
 
-def geocode_place(place: str):
+# 座標取得（Nominatim + Open-Meteo フォールバック、ヘッジリクエスト）
+def _geocode_nominatim(place: str):
     g = Nominatim(user_agent="weather_app")
-    loc = g.geocode(place)
+    loc = g.geocode(place, timeout=10)
     if not loc:
-        raise ValueError(f"場所が見つかりませんでした: {place}")
+        return None
     return loc.latitude, loc.longitude
 
+def _geocode_open_meteo(place: str):
+    r = call_api("https://geocoding-api.open-meteo.com/v1/search",
+                 {"name": place, "count": 1, "language": "ja", "format": "json"})
+    if not r.get("results"):
+        return None
+    return r["results"][0]["latitude"], r["results"][0]["longitude"]
+
+GEOCODER = HedgedChain([
+    ("Nominatim", _geocode_nominatim),
+    ("Open-Meteo", _geocode_open_meteo),
+])
+
+def geocode_place(place: str):
+    coords = GEOCODER.call(place)
+    if not coords:
+        raise ValueError(f"場所が見つかりませんでした: {place}")
+    return coords
+
 def call_api(url, params):
     r = requests.get(url, params=params, timeout=30)
     r.raise_for_status()
@@ -40,50 +63,119 @@ def fetch_daily(api_url, lat, lon, start_date, end_date, include_weathercode=Tru
     r = call_api(api_url, params)
     return r.get("daily", {})
 
-def get_weather(lat, lon, start_date_str, end_date_str):
+# 取得元ごとの対象範囲（今日からの日数）。JMA は日本国内のみ有効
+JMA_URL = "https://api.open-meteo.com/v1/jma"
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+CLIMATE_URL = "https://climate-api.open-meteo.com/v1/climate"
+
+WEATHER_SOURCES = [
+    {"source": "JMA", "url": JMA_URL, "horizon_days": 3, "weathercode": True, "japan_only": True},
+    {"source": "Forecast", "url": FORECAST_URL, "horizon_days": 14, "weathercode": True, "japan_only": False},
+]
+CLIMATE_SOURCE = {"source": "Climate", "url": CLIMATE_URL, "weathercode": False}
+
+# 日本の陸域（本州・北海道・四国・九州・対馬・南西諸島・伊豆/小笠原）の大まかな範囲
+# 朝鮮半島（釜山・蔚山）やウラジオストクを含まないよう島ごとに分けている
+JAPAN_BOXES = [
+    # (緯度 min, 緯度 max, 経度 min, 経度 max)
+    (41.3, 45.6, 139.3, 146.0),   # 北海道
+    (33.4, 41.6, 135.0, 142.2),   # 本州（近畿〜東北）
+    (32.7, 36.4, 130.8, 135.0),   # 中国・四国
+    (30.9, 34.0, 129.4, 132.1),   # 九州
+    (34.0, 34.8, 129.1, 129.6),   # 対馬
+    (28.0, 30.9, 128.9, 131.2),   # 奄美・トカラ
+    (24.0, 28.0, 122.9, 131.4),   # 沖縄・先島
+    (24.0, 33.4, 138.9, 142.5),   # 伊豆諸島・小笠原
+]
+
+def is_in_japan(lat, lon):
+    return any(lat_min <= lat <= lat_max and lon_min <= lon <= lon_max
+               for lat_min, lat_max, lon_min, lon_max in JAPAN_BOXES)
+
+def plan_for_dates(lat, lon, dates, today=None, asked=None):
+    """dates を埋めるのに必要な最小の (取得元, 期間) を返す（plan, skipped）
+    asked: {取得元: 既に問い合わせた日付の set}。問い合わせ済みの日はその取得元に再度割り当てない"""
+    today = today or datetime.now().date()
+    asked = asked or {}
+    remaining = sorted(dates)
+    plan, skipped = [], []
+
+    for src in WEATHER_SOURCES:
+        if not remaining:
+            skipped.append({"source": src["source"], "reason": "全日をカバー済み"})
+            continue
+        if src["japan_only"] and not is_in_japan(lat, lon):
+            skipped.append({"source": src["source"], "reason": "対象地域外（日本国外）"})
+            continue
+        horizon_end = today + timedelta(days=src["horizon_days"])
+        covered = [d for d in remaining
+                   if today <= d <= horizon_end and d not in asked.get(src["source"], set())]
+        if not covered:
+            skipped.append({"source": src["source"], "reason": f"予報範囲外または問い合わせ済み（{today}〜{horizon_end}）"})
+            continue
+        plan.append({**src, "start": covered[0], "end": covered[-1]})
+        remaining = [d for d in remaining if d not in covered]
+
+    remaining = [d for d in remaining if d not in asked.get(CLIMATE_SOURCE["source"], set())]
+    if remaining:
+        # 予報範囲の前後に分かれても 1 回の呼び出しにまとめる
+        plan.append({**CLIMATE_SOURCE, "start": remaining[0], "end": remaining[-1]})
+    else:
+        skipped.append({"source": CLIMATE_SOURCE["source"], "reason": "全日をカバー済み"})
+
+    return plan, skipped
+
+def plan_weather_requests(lat, lon, start_dt, end_dt, today=None):
+    """start_dt〜end_dt の全日を埋めるのに必要な最小の (取得元, 期間) を返す（plan, skipped）"""
+    dates = [start_dt + timedelta(days=i) for i in range((end_dt - start_dt).days + 1)]
+    return plan_for_dates(lat, lon, dates, today)
+
+def execute_weather_plan(lat, lon, plan, results, needed):
+    for req in plan:
+        daily = fetch_daily(req["url"], lat, lon,
+                            req["start"].strftime("%Y-%m-%d"), req["end"].strftime("%Y-%m-%d"),
+                            include_weathercode=req["weathercode"])
+        for i, ds in enumerate(daily.get("time", [])):
+            if ds not in needed or (ds in results and results[ds]["temp_max"] is not None):
+                continue
+            if req["weathercode"]:
+                code = daily["weathercode"][i]
+                weather = WEATHER_CODE_JP.get(code, f"不明（コード:{code})")
+            else:
+                weather = "(長期傾向のみ: weathercodeなし)"
+            results[ds] = {
+                "date": ds, "source": req["source"],
+                "temp_max": daily["temperature_2m_max"][i],
+                "temp_min": daily["temperature_2m_min"][i],
+                "precipitation": daily["precipitation_sum"][i],
+                "weather": weather
+            }
+
+def get_weather(lat, lon, start_date_str, end_date_str, today=None):
     start_dt = datetime.fromisoformat(start_date_str).date()
     end_dt   = datetime.fromisoformat(end_date_str).date()
+    needed = {(start_dt + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_dt - start_dt).days + 1)}
     results = {}
 
-    # --- JMA（4日以内） ---
-    jma_end = min(start_dt + timedelta(days=3), end_dt)
-    jma = fetch_daily("https://api.open-meteo.com/v1/jma", lat, lon,
-                      start_dt.strftime("%Y-%m-%d"), jma_end.strftime("%Y-%m-%d"))
-    for i, ds in enumerate(jma.get("time", [])):
-        results[ds] = {
-            "date": ds, "source": "JMA",
-            "temp_max": jma["temperature_2m_max"][i],
-            "temp_min": jma["temperature_2m_min"][i],
-            "precipitation": jma["precipitation_sum"][i],
-            "weather": WEATHER_CODE_JP.get(jma["weathercode"][i], f"不明（コード:{jma['weathercode'][i]})")
-        }
-
-    # --- Forecast（最大15日以内、今日 +14日まで） ---
-    fc_end = min(start_dt + timedelta(days=14), end_dt)
-    fc = fetch_daily("https://api.open-meteo.com/v1/forecast", lat, lon,
-                     start_dt.strftime("%Y-%m-%d"), fc_end.strftime("%Y-%m-%d"))
-    for i, ds in enumerate(fc.get("time", [])):
-        if ds not in results or results[ds]["temp_max"] is None:
-            results[ds] = {
-                "date": ds, "source": "Forecast",
-                "temp_max": fc["temperature_2m_max"][i],
-                "temp_min": fc["temperature_2m_min"][i],
-                "precipitation": fc["precipitation_sum"][i],
-                "weather": WEATHER_CODE_JP.get(fc["weathercode"][i], f"不明（コード:{fc['weathercode'][i]})")
-            }
+    # --- 必要な取得元・期間だけを計画して実行 ---
+    plan, skipped = plan_weather_requests(lat, lon, start_dt, end_dt, today)
+    for s in skipped:
+        print(f"⏭ {s['source']} の呼び出しをスキップ: {s['reason']}")
+    execute_weather_plan(lat, lon, plan, results, needed)
 
-    # --- Climate（17日以降、または欠損補完用） ---
-    cl = fetch_daily("https://climate-api.open-meteo.com/v1/climate", lat, lon,
-                     start_dt.strftime("%Y-%m-%d"), end_dt.strftime("%Y-%m-%d"),
-                     include_weathercode=False)
-    for i, ds in enumerate(cl.get("time", [])):
-        if ds not in results or results[ds]["temp_max"] is None:
-            results[ds] = {
-                "date": ds, "source": "Climate",
-                "temp_max": cl["temperature_2m_max"][i],
-                "temp_min": cl["temperature_2m_min"][i],
-                "precipitation": cl["precipitation_sum"][i],
-                "weather": "(長期傾向のみ: weathercodeなし)"
-            }
+    # --- 欠損（値なし）の日は、その日をまだ問い合わせていない取得元で補完（Climate は最後） ---
+    asked = {}
+    while True:
+        for req in plan:
+            span = asked.setdefault(req["source"], set())
+            span.update(req["start"] + timedelta(days=i) for i in range((req["end"] - req["start"]).days + 1))
+        gaps = sorted(d for d in needed if d not in results or results[d]["temp_max"] is None)
+        if not gaps:
+            break
+        plan, _ = plan_for_dates(lat, lon, [datetime.fromisoformat(d).date() for d in gaps], today, asked)
+        if not plan:
+            break
+        print(f"🩹 欠損補完: {', '.join(req['source'] for req in plan)}（{len(gaps)}日分）")
+        execute_weather_plan(lat, lon, plan, results, set(gaps))
 
     return [results[d] for d in sorted(results.keys())]